@@ -9,10 +9,24 @@ Use the `estimate_mi` method in the main ennemi module instead.
 
 import numpy as np
 from scipy.spatial import cKDTree
-from typing import Union
+from typing import Sequence, Union
 from warnings import warn
 
 
+# cKDTree queries release the GIL and can run on all cores with workers=-1.
+# This only pays off for large point sets: small queries are dominated by
+# thread start-up, and the driver may already run estimates in parallel.
+_PARALLEL_QUERY_THRESHOLD = 1000
+
+def _query_workers(n: int) -> int:
+    """The number of threads to use for kd-tree queries over n points."""
+
+    if n >= _PARALLEL_QUERY_THRESHOLD:
+        return -1
+    else:
+        return 1
+
+
 def _estimate_single_entropy(x: np.ndarray, k: int = 3) -> float:
     """Estimate the differential entropy of a n-dimensional random variable.
 
@@ -24,14 +38,15 @@ def _estimate_single_entropy(x: np.ndarray, k: int = 3) -> float:
     information. Physical Review E 69. doi:10.1103/PhysRevE.69.066138
     """
 
+    x = np.asarray(x, dtype=np.float64)
     if x.ndim == 1:
         x = x.reshape((x.size,1))
 
     N, ndim = x.shape
-    grid = cKDTree(x, k)
+    grid = cKDTree(x)
 
     # Search for the k'th neighbor of each point and store the distance
-    distances = grid.query(x, k=[k+1], p=np.inf)[0].flatten()
+    distances = grid.query(x, k=[k+1], p=np.inf, workers=_query_workers(N))[0].ravel()
 
     # The log(2) term is because the mean is taken over double the distances
     return _psi(N) - _psi(k) + ndim * (np.mean(np.log(distances)) + np.log(2))
@@ -60,71 +75,145 @@ def _estimate_single_mi(x: np.ndarray, y: np.ndarray, k: int = 3) -> float:
 
     N = len(x)
 
-    # Ensure that x and y are 2-dimensional
-    x = np.column_stack((x,))
-    y = np.column_stack((y,))
+    # cKDTree stores its coordinates as float64 and converts any other dtype
+    # on every build and query. Converting once up front lets the tree, the
+    # queries and the marginal searches share the same buffers.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
 
     # We use the fastest O(N*sqrt(k)) time algorithm
-    # Create the 2D tree for finding the k-th neighbor and marginal 1D trees
+    # Create the 2D tree for finding the k-th neighbor
     xy = np.column_stack((x, y))
+    grid = cKDTree(xy)
+    eps = grid.query(xy, k=[k+1], p=np.inf, workers=_query_workers(N))[0].ravel()
+
+    # The marginal neighbors are counted on sorted 1D arrays:
+    # each marginal is sorted once and then all N intervals are counted
+    # in one vectorized binary search. Unlike a kd-tree ball query,
+    # _count_within is strict and therefore needs no radius tweak
+    # (https://github.com/polsys/ennemi/issues/76).
+    # The counts include the point itself, as in Kraskov et al. (psi(n+1)).
+    nx = _count_within(np.sort(x), x - eps, x + eps)
+    ny = _count_within(np.sort(y), y - eps, y + eps)
+
+    # Calculate the estimate, applying the digamma function on full count arrays
+    return _psi(N) + _psi(k) - np.mean(_psi(nx)) - np.mean(_psi(ny))
+
 
+def _estimate_single_mi_many_k(x: np.ndarray, y: np.ndarray,
+        ks: Sequence[int]) -> np.ndarray:
+    """Estimate the MI between two continuous variables for several k at once.
+
+    This matches _estimate_single_mi evaluated at each element of `ks`
+    (which must be in ascending order), but the joint tree is built and
+    traversed only once for all the neighbor counts.
+    Returns an array of estimates in the order of `ks`.
+    """
+
+    N = len(x)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # A single query returns the neighbor distances at every requested order
+    xy = np.column_stack((x, y))
     grid = cKDTree(xy)
-    x_grid = cKDTree(x)
-    y_grid = cKDTree(y)
+    eps = grid.query(xy, k=[k + 1 for k in ks], p=np.inf, workers=_query_workers(N))[0]
 
-    # We have to subtract a small value from the radius
-    # because the algorithm expects strict inequality but cKDTree also allows equality.
-    # This assumes that the radius is of roughly unit magnitude.
-    # See https://github.com/polsys/ennemi/issues/76 for justification.
-    eps = grid.query(xy, k=[k+1], p=np.inf)[0].flatten()
-    nx = x_grid.query_ball_point(x, eps - 1e-12, p=np.inf, return_length=True)
-    ny = y_grid.query_ball_point(y, eps - 1e-12, p=np.inf, return_length=True)
+    # The sorted marginals are likewise shared by all the k values
+    sorted_x = np.sort(x)
+    sorted_y = np.sort(y)
 
-    # Calculate the estimate
-    return _psi(N) + _psi(k) - np.mean(_psi(nx) + _psi(ny))
+    result = np.empty(len(ks))
+    for (i, k) in enumerate(ks):
+        nx = _count_within(sorted_x, x - eps[:,i], x + eps[:,i])
+        ny = _count_within(sorted_y, y - eps[:,i], y + eps[:,i])
+        result[i] = _psi(N) + _psi(k) - np.mean(_psi(nx)) - np.mean(_psi(ny))
 
+    return result
 
-def _estimate_conditional_mi(x: np.ndarray, y: np.ndarray, cond: np.ndarray, 
-        k: int = 3) -> float:
+
+def _estimate_conditional_mi(x: np.ndarray, y: np.ndarray, cond: np.ndarray,
+        k: int = 3, fast_gaussian: bool = False) -> float:
     """Estimate conditional mutual information between two continuous variables.
 
     See the documentation for estimate_single_mi for usage.
     The only difference is the additional continuous variable used for
     conditioning.
 
+    If `fast_gaussian` is set, the correlation between x and y is compared
+    to the correlation of their residuals after regressing out the condition.
+    If conditioning does not move the correlation, the condition is deemed
+    independent of (x, y) and the cheaper unconditional estimator is used.
+    This check only sees linear dependence, so the flag must be left off
+    whenever a non-linear conditional effect is possible.
+
     The calculation is based on Frenzel & Pompe (2007): Partial Mutual
     Information for Coupling Analysis of Multivariate Time Series.
     Physical Review Letters 99. doi:10.1103/PhysRevLett.99.204101
     """
 
-    # Ensure that cond is 2-dimensional
-    cond = np.column_stack((cond,))
+    # Ensure that cond is 2-dimensional, and convert everything to the
+    # float64 coordinates used by the kd-trees just once
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    cond = np.column_stack((cond,)).astype(np.float64, copy=False)
+
+    if fast_gaussian and _is_linearly_independent_condition(x, y, cond):
+        return _estimate_single_mi(x, y, k)
 
     # The cKDTree class offers a lot of vectorization
     # First, create N-dimensional trees for variables
+    # The marginal projections are created just once and shared with the trees
     xyz = np.column_stack((x, y, cond))
-    full_grid = cKDTree(xyz)
+    xz_proj = np.column_stack((x, cond))
+    yz_proj = np.column_stack((y, cond))
 
-    xz_grid = cKDTree(np.column_stack((x, cond)))
-    yz_grid = cKDTree(np.column_stack((y, cond)))
-    z_grid = cKDTree(cond)
+    full_grid = cKDTree(xyz)
+    xz_grid = cKDTree(xz_proj)
+    yz_grid = cKDTree(yz_proj)
 
     # Find the distance to the k'th neighbor of each point
-    eps = full_grid.query(xyz, k=[k+1], p=np.inf)[0].flatten()
-
-    # Find the number of neighbors in marginal spaces
-    xz_proj = np.column_stack((x, cond))
-    yz_proj = np.column_stack((y, cond))
+    workers = _query_workers(len(x))
+    eps = full_grid.query(xyz, k=[k+1], p=np.inf, workers=workers)[0].ravel()
 
     # We have to subtract a small value from the radius
     # because the algorithm expects strict inequality but cKDTree also allows equality.
     # This assumes that the radius is of roughly unit magnitude.
     # See https://github.com/polsys/ennemi/issues/76 for justification.
-    nxz = xz_grid.query_ball_point(xz_proj, eps - 1e-12, p=np.inf, return_length=True)
-    nyz = yz_grid.query_ball_point(yz_proj, eps - 1e-12, p=np.inf, return_length=True)
-    nz = z_grid.query_ball_point(cond, eps - 1e-12, p=np.inf, return_length=True)
+    nxz = xz_grid.query_ball_point(xz_proj, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
+    nyz = yz_grid.query_ball_point(yz_proj, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
+
+    # With a one-dimensional condition, the condition marginal reduces to
+    # interval counting on a sorted array; this skips one tree build and
+    # needs no radius tweak. Higher-dimensional conditions use a kd-tree.
+    if cond.shape[1] == 1:
+        z = cond.ravel()
+        nz = _count_within(np.sort(z), z - eps, z + eps)
+    else:
+        z_grid = cKDTree(cond)
+        nz = z_grid.query_ball_point(cond, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
+
+    return _psi(k) - np.mean(_psi(nxz)) - np.mean(_psi(nyz)) + np.mean(_psi(nz))
+
+
+def _is_linearly_independent_condition(x: np.ndarray, y: np.ndarray,
+        cond: np.ndarray) -> bool:
+    """Check whether conditioning leaves the x-y correlation unchanged.
+
+    Compares the sample correlation of x and y to the partial correlation
+    given the condition (computed from regression residuals). The two match
+    within sampling noise, here bounded by 2/sqrt(N), when the condition
+    is linearly independent of both variables.
+    """
+
+    N = len(x)
+    design = np.column_stack((np.ones(N), cond))
+    x_res = x - design @ np.linalg.lstsq(design, x, rcond=None)[0]
+    y_res = y - design @ np.linalg.lstsq(design, y, rcond=None)[0]
 
-    return _psi(k) - np.mean(_psi(nxz) + _psi(nyz) - _psi(nz))
+    rho = np.corrcoef(x, y)[0,1]
+    partial_rho = np.corrcoef(x_res, y_res)[0,1]
+    return bool(abs(partial_rho - rho) < 2 / np.sqrt(N))
 
 
 def _estimate_semidiscrete_mi(x: np.ndarray, y: np.ndarray, k: int = 3) -> float:
@@ -141,9 +230,10 @@ def _estimate_semidiscrete_mi(x: np.ndarray, y: np.ndarray, k: int = 3) -> float
     
     N = len(x)
 
-    # Ensure that x is 2-dimensional
-    x = np.column_stack((x,))
-    
+    # Ensure that x is 2-dimensional float64 for the kd-trees
+    x = np.asarray(x, dtype=np.float64)
+    x2d = np.column_stack((x,))
+
     # Find the unique values of y
     y_values, y_counts = np.unique(y, return_counts=True)
 
@@ -151,23 +241,25 @@ def _estimate_semidiscrete_mi(x: np.ndarray, y: np.ndarray, k: int = 3) -> float
         warn("The discrete variable has relatively many unique values." +
             " Did you pass y and x in correct order?", UserWarning)
 
-    # Create trees for each y value and for the marginal x space
-    grids = [cKDTree(x[y==val]) for val in y_values]
-    x_grid = cKDTree(x)
+    # The marginal x space is sorted once and shared across all y levels;
+    # the neighbor counts are then vectorized interval counts
+    sorted_x = np.sort(x)
 
     # For each y value:
     # - Find the distance to the k'th neighbor sharing the y value
     # - Find the number of neighbors within that distance in the marginal x space
-    # See https://github.com/polsys/ennemi/issues/76 for (eps - 1e-12) tweak.
-    n_full = np.empty(N)
-    for i, val in enumerate(y_values):
-        subset = x[y==val]
-        eps = grids[i].query(subset, k=[k+1], p=np.inf)[0].flatten()
-        
-        n_full[y==val] = x_grid.query_ball_point(subset, eps - 1e-12, p=np.inf, return_length=True)
+    # The y mask and the x subset are computed only once per level.
+    n_full = np.empty(N, dtype=np.int64)
+    for val in y_values:
+        mask = (y == val)
+        subset = x2d[mask]
+        eps = cKDTree(subset).query(subset, k=[k+1], p=np.inf,
+            workers=_query_workers(len(subset)))[0].ravel()
+
+        n_full[mask] = _count_within(sorted_x, x[mask] - eps, x[mask] + eps)
 
     # The mean of psi(y_counts) is taken over all sample points, not y buckets
-    weighted_y_counts_mean = np.sum(np.dot(_psi(y_counts), y_counts / N))
+    weighted_y_counts_mean = np.dot(_psi(y_counts), y_counts / N)
     return _psi(N) + _psi(k) - np.mean(_psi(n_full)) - weighted_y_counts_mean
 
 
@@ -179,9 +271,11 @@ def _estimate_conditional_semidiscrete_mi(x: np.ndarray, y: np.ndarray, cond: np
     discrete-continuous distance metric.
     """
 
-    # Ensure that cond is 2-dimensional
+    # Ensure that cond is 2-dimensional; the continuous variables are
+    # converted to kd-tree float64 coordinates just once
     N = len(y)
-    cond = np.column_stack((cond,))
+    x = np.asarray(x, dtype=np.float64)
+    cond = np.column_stack((cond,)).astype(np.float64, copy=False)
 
     # Find the unique values of y
     y_values = np.unique(y)
@@ -190,50 +284,100 @@ def _estimate_conditional_semidiscrete_mi(x: np.ndarray, y: np.ndarray, cond: np
         warn("The discrete variable has relatively many unique values." +
             " Did you pass y and x in correct order?", UserWarning)
 
-    # First, create N-dimensional trees for variables
-    # The full space is partitioned according to y levels
+    # First, create N-dimensional trees for the unpartitioned spaces.
+    # As in _estimate_conditional_mi, a one-dimensional condition marginal
+    # is counted on sorted arrays instead of kd-trees; the sorted full
+    # condition is shared across all y levels.
     xz = np.column_stack((x, cond))
-    full_grids = [cKDTree(xz[y==val]) for val in y_values]
-
     xz_grid = cKDTree(xz)
-    z_grid = cKDTree(cond)
-
-    # Similarly, the YZ marginal space is partitioned between y levels
-    yz_grids = [cKDTree(cond[y==val]) for val in y_values]
+    if cond.shape[1] == 1:
+        sorted_z = np.sort(cond.ravel())
+    else:
+        z_grid = cKDTree(cond)
 
     # Find the distance to the k'th neighbor of each point
     # in the y-partitioned spaces, and find the number of neighbors
     # in marginal spaces.
-    xz_proj = np.column_stack((x, cond))
-    nxz = np.empty(N)
-    nyz = np.empty(N)
-    nz = np.empty(N)
-
-    for i, val in enumerate(y_values):
-        subset = y==val
-        eps = full_grids[i].query(xz[subset], k=[k+1], p=np.inf)[0].flatten()
+    # The full space and the YZ marginal space are partitioned by y level;
+    # each mask and subset is computed only once per level.
+    nxz = np.empty(N, dtype=np.int64)
+    nyz = np.empty(N, dtype=np.int64)
+    nz = np.empty(N, dtype=np.int64)
+
+    for val in y_values:
+        mask = (y == val)
+        xz_subset = xz[mask]
+        z_subset = cond[mask]
+        workers = _query_workers(len(z_subset))
+        eps = cKDTree(xz_subset).query(xz_subset, k=[k+1], p=np.inf, workers=workers)[0].ravel()
 
         # See https://github.com/polsys/ennemi/issues/76 for (eps - 1e-12) tweak.
-        nxz[subset] = xz_grid.query_ball_point(xz_proj[subset], eps - 1e-12, p=np.inf, return_length=True)
-        nyz[subset] = yz_grids[i].query_ball_point(cond[subset], eps - 1e-12, p=np.inf, return_length=True)
-        nz[subset] = z_grid.query_ball_point(cond[subset], eps - 1e-12, p=np.inf, return_length=True)
+        nxz[mask] = xz_grid.query_ball_point(xz_subset, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
+        if cond.shape[1] == 1:
+            zs = z_subset.ravel()
+            nyz[mask] = _count_within(np.sort(zs), zs - eps, zs + eps)
+            nz[mask] = _count_within(sorted_z, zs - eps, zs + eps)
+        else:
+            nyz[mask] = cKDTree(z_subset).query_ball_point(z_subset, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
+            nz[mask] = z_grid.query_ball_point(z_subset, eps - 1e-12, p=np.inf, return_length=True, workers=workers)
 
-    return _psi(k) - np.mean(_psi(nxz) + _psi(nyz) - _psi(nz))
+    return _psi(k) - np.mean(_psi(nxz)) - np.mean(_psi(nyz)) + np.mean(_psi(nz))
+
+
+#
+# Neighbor counting
+#
+
+def _count_within(array: np.ndarray, lower: Union[float, np.ndarray],
+        upper: Union[float, np.ndarray]) -> np.ndarray:
+    """Count the array elements strictly between the two bounds.
+
+    The array must be sorted in ascending order. The bounds may be scalars
+    or arrays of query intervals; in the latter case all the counts are
+    computed in a single vectorized binary search.
+
+    Elements exactly equal to a bound are excluded, matching the strict
+    inequality required by the Kraskov et al. estimator.
+    """
+
+    left = np.searchsorted(array, lower, side="right")
+    right = np.searchsorted(array, upper, side="left")
+    return np.maximum(right - left, 0)
 
 
 #
 # Digamma
 #
 
+# Exact digamma values for small integer arguments, from the recurrence
+# psi(n) = -euler_gamma + (1 + 1/2 + ... + 1/(n-1)). Neighbor counts are
+# integers and usually small, so most arguments are a single table load.
+# psi(0) = inf for SciPy compatibility.
+_PSI_LUT = np.full(256, -np.euler_gamma)
+_PSI_LUT[0] = np.inf
+_PSI_LUT[2:] += np.cumsum(1.0 / np.arange(1, _PSI_LUT.size - 1))
+
+
 def _psi(x: Union[int, np.ndarray]) -> np.ndarray:
     """A replacement for scipy.special.psi, for non-negative integers only.
-    
+
     This is slightly faster than the SciPy version (not that it's a bottleneck),
     and has consistent behavior for digamma(0).
     """
-    
+
     x = np.asarray(x)
 
+    # Integer arguments within the lookup table are exact.
+    # Negative values must not wrap around to the end of the table;
+    # they fall through to the expansion and propagate NaN as before.
+    if x.dtype.kind in "iu" and np.all(x >= 0) and np.all(x < _PSI_LUT.size):
+        return _PSI_LUT[x]
+
+    # Convert to a float array once, so that the ufunc arithmetic below
+    # runs on the fast vectorized path (count arrays are contiguous already;
+    # ascontiguousarray is not used as it would promote scalars to 1D)
+    x = np.asarray(x, dtype=np.float64)
+
     # psi(0) = inf for SciPy compatibility
     # The shape of result does not matter as inf will propagate in mean()
     if np.any(x == 0):
@@ -245,7 +389,7 @@ def _psi(x: Union[int, np.ndarray]) -> np.ndarray:
 
     # For the rest, a good enough expansion is given by
     # https://www.uv.es/~bernardo/1976AppStatist.pdf
-    y = np.asarray(x[mask], dtype=np.float64)
+    y = x[mask]
     result[mask] = np.log(y) - np.power(y, -6) * (np.power(y, 2) * (np.power(y, 2) * (y/2 + 1/12) - 1/120) + 1/252)
 
     return result
@@ -3,17 +3,70 @@
 
 """Tests for ennemi._estimate_single_mi() and friends."""
 
+import functools
 import math
 from math import log
 import numpy as np
+import pytest
 from scipy.special import gamma, psi
 from scipy.stats import gamma as gamma_dist
+from typing import Optional, Sequence, Union
 import unittest
 from ennemi._entropy_estimators import _estimate_single_entropy,\
-    _estimate_single_mi, _estimate_conditional_mi,\
+    _estimate_single_mi, _estimate_single_mi_many_k, _estimate_conditional_mi,\
     _estimate_semidiscrete_mi, _estimate_conditional_semidiscrete_mi
 
 
+@functools.lru_cache(maxsize=None)
+def _mvn_factor(cov_bytes: bytes, dim: int) -> np.ndarray:
+    """Factorize a covariance matrix, passed as raw bytes for cacheability."""
+
+    cov = np.frombuffer(cov_bytes).reshape((dim, dim))
+    u, s, _ = np.linalg.svd(cov)
+    return (u * np.sqrt(s)).T
+
+
+def _sample_mvn(rng: np.random.Generator, cov: np.ndarray, n: int,
+        out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Sample n points of a zero-mean multivariate normal distribution.
+
+    This produces exactly the same values as rng.multivariate_normal(),
+    but the decomposition of the covariance matrix is computed only once
+    per matrix instead of on every call. (A Cholesky factor would be cheaper
+    still, but it yields a different sample, and the accuracy deltas in these
+    tests are calibrated against the current draws.)
+
+    If `out` is given, the sample is written into it instead of a fresh
+    array, so a loop over sample sizes can reuse one buffer.
+    """
+
+    cov = np.asarray(cov, dtype=np.float64)
+    factor = _mvn_factor(cov.tobytes(), cov.shape[0])
+    return np.matmul(rng.standard_normal((n, cov.shape[0])), factor, out=out)
+
+
+@functools.lru_cache(maxsize=None)
+def _mvn_corpus(rho: float, seed: int) -> np.ndarray:
+    """A frozen unit-variance bivariate Gaussian sample at the largest size used.
+
+    Subtests with a smaller n slice a prefix of the corpus. Because standard
+    normal draws fill the array in row-major order, the first n rows are
+    bit for bit the same as a separate size-n draw from the same seed.
+    """
+
+    cov = np.array([[1, rho], [rho, 1]])
+    return _sample_mvn(np.random.default_rng(seed), cov, 2000)
+
+
+def _gaussian_mi(rho: float) -> float:
+    """The analytic MI of a bivariate unit Gaussian: -0.5 * log(1 - rho^2).
+
+    log1p keeps the expression accurate as |rho| tends to 1.
+    """
+
+    return -0.5 * math.log1p(-rho * rho)
+
+
 class TestEstimateSingleEntropy(unittest.TestCase):
 
     def test_univariate_gaussian(self) -> None:
@@ -56,11 +109,13 @@ class TestEstimateSingleEntropy(unittest.TestCase):
                   (0.6, 0.5, 2000, 3, 0.04),
                   (0.9, 1, 2000, 3, 0.04),
                   (-0.5, 1, 2000, 5, 0.03), ]
+        # One buffer serves every subtest; smaller cases use a prefix view
+        buf = np.empty((2000, 2))
         for (rho, var1, n, k, delta) in cases:
             with self.subTest(rho=rho, var1=var1, n=n, k=k):
                 rng = np.random.default_rng(2)
                 cov = np.array([[var1, rho], [rho, 1]])
-                data = rng.multivariate_normal([0, 0], cov, size=n)
+                data = _sample_mvn(rng, cov, n, out=buf[:n])
 
                 actual = _estimate_single_entropy(data, k=k)
                 expected = 0.5 * log(np.linalg.det(2 * math.pi * math.e * cov))
@@ -73,7 +128,7 @@ class TestEstimateSingleEntropy(unittest.TestCase):
             [ 0.5,  1.0,  0.7, -0.5],
             [ 0.6,  0.7,  2.0, -0.1],
             [-0.2, -0.5, -0.1,  0.5]])
-        data = rng.multivariate_normal([0, 0, 0, 0], cov, size=2000)
+        data = _sample_mvn(rng, cov, 2000)
 
         actual = _estimate_single_entropy(data, k=3)
         expected = 0.5 * log(np.linalg.det(2 * math.pi * math.e * cov))
@@ -102,91 +157,108 @@ class TestEstimateSingleEntropy(unittest.TestCase):
         self.assertAlmostEqual(trans, expected, delta=0.01)
 
 
-class TestEstimateSingleMi(unittest.TestCase):
-
-    def test_bivariate_gaussian(self) -> None:
-        cases = [ (0, 40, 3, 0.1),
-                  (0, 200, 3, 0.06),
-                  (0, 2000, 3, 0.005),
-                  (0, 2000, 5, 0.006),
-                  (0, 2000, 20, 0.003),
-                  (0.5, 200, 3, 0.05),
-                  (0.5, 200, 5, 0.02),
-                  (0.5, 2000, 3, 0.02),
-                  (-0.9, 200, 3, 0.05),
-                  (-0.9, 2000, 3, 0.05),
-                  (-0.9, 2000, 5, 0.02), ]
-        for (rho, n, k, delta) in cases:
-            with self.subTest(rho=rho, n=n, k=k):
-                rng = np.random.default_rng(0)
-                cov = np.array([[1, rho], [rho, 1]])
-
-                data = rng.multivariate_normal([0, 0], cov, size=n)
-                x = data[:,0]
-                y = data[:,1]
-
-                actual = _estimate_single_mi(x, y, k=k)
-                expected = -0.5 * log(1 - rho**2)
-                self.assertAlmostEqual(actual, expected, delta=delta)
-
-    def test_sum_of_exponentials(self) -> None:
-        # We define X ~ Exp(1), W ~ Exp(2) and Y = X + W.
-        # Now by arXiv:1609.02911, Y has known, closed-form entropy.
-        cases = [ (1, 2), (0.2, 0.3), (3, 3.1) ]
-        for (a, b) in cases:
-            with self.subTest(a=a, b=b):
-                rng = np.random.default_rng(20200302)
-                x = rng.exponential(1/a, 1000)
-                w = rng.exponential(1/b, 1000)
-                y = x + w
-
-                actual = _estimate_single_mi(x, y, k=5)
-                expected = np.euler_gamma + log((b-a)/a) + psi(b/(b-a))
-
-                self.assertAlmostEqual(actual, expected, delta=0.025)
-
-    def test_independent_uniform(self) -> None:
-        # We have to use independent random numbers instead of linspace,
-        # because the algorithm has trouble with evenly spaced values
-        rng = np.random.default_rng(1)
-        x = rng.uniform(0.0, 1.0, 1024)
-        y = rng.uniform(0.0, 1.0, 1024)
-
-        actual = _estimate_single_mi(x, y, k=8)
-        actual2 = _estimate_single_mi(y, x, k=8)
-        self.assertAlmostEqual(actual, 0, delta=0.04)
-        self.assertAlmostEqual(actual, actual2, delta=0.00001)
-
-    def test_independent_transformed_uniform(self) -> None:
-        # Very non-uniform density, but MI should still be zero
-        rng = np.random.default_rng(1)
-        x = rng.uniform(0.0, 10.0, 1024)
-        y = np.exp(rng.uniform(0.0, 1.0, 1024))
-
-        actual = _estimate_single_mi(x, y, k=8)
-        self.assertAlmostEqual(actual, 0, delta=0.02)
-
-    def test_gamma_exponential(self) -> None:
-        # Kraskov et al. mention that this distribution is hard to estimate
-        # without logarithming the values.
-        # The analytical result is due to doi:10.1109/18.825848.
-        #
-        # x1      ~ Gamma(rate, shape)
-        # x2 | x1 ~ Exp(t * x1)
-        rng = np.random.default_rng(2)
-        r = 1.2
-        s = 3.4
-        t = 0.56
-
-        x1 = rng.gamma(shape=s, scale=1/r, size=1000)
-        x2 = rng.exponential(x1 * t)
-
-        raw = _estimate_single_mi(x1, x2)
-        trans = _estimate_single_mi(np.log(x1), np.log(x2))
-
-        expected = psi(s) - np.log(s) + 1/s
-        self.assertAlmostEqual(raw, expected, delta=0.04)
-        self.assertAlmostEqual(trans, expected, delta=0.005)
+# The single-MI cases are plain pytest functions parametrized per case,
+# so that pytest-xdist (pytest -n auto) can spread them across cores.
+# The n >= 2000 cases are marked slow so that CI can split them off.
+
+_BIVARIATE_GAUSSIAN_CASES = [
+    pytest.param(0, 40, 3, 0.1),
+    pytest.param(0, 200, 3, 0.06),
+    pytest.param(0, 2000, 3, 0.005, marks=pytest.mark.slow),
+    pytest.param(0, 2000, 5, 0.006, marks=pytest.mark.slow),
+    pytest.param(0, 2000, 20, 0.003, marks=pytest.mark.slow),
+    pytest.param(0.5, 200, 3, 0.05),
+    pytest.param(0.5, 200, 5, 0.02),
+    pytest.param(0.5, 2000, 3, 0.02, marks=pytest.mark.slow),
+    pytest.param(-0.9, 200, 3, 0.05),
+    pytest.param(-0.9, 2000, 3, 0.05, marks=pytest.mark.slow),
+    pytest.param(-0.9, 2000, 5, 0.02, marks=pytest.mark.slow),
+]
+
+@pytest.mark.parametrize("rho, n, k, delta", _BIVARIATE_GAUSSIAN_CASES)
+def test_single_mi_bivariate_gaussian(rho: float, n: int, k: int, delta: float) -> None:
+    # Each case slices the shared corpus, so the sample is bit for bit
+    # the same as drawing it separately per (rho, n) pair
+    data = _mvn_corpus(rho, 0)[:n]
+
+    actual = _estimate_single_mi(data[:,0], data[:,1], k)
+    assert actual == pytest.approx(_gaussian_mi(rho), abs=delta)
+
+def test_single_mi_many_k_matches_separate_estimation() -> None:
+    # The batched estimator must agree exactly with per-k estimation
+    data = _mvn_corpus(0.5, 0)[:200]
+    x = data[:,0]
+    y = data[:,1]
+
+    ks = [1, 3, 8]
+    batch = _estimate_single_mi_many_k(x, y, ks)
+    for (i, k) in enumerate(ks):
+        assert batch[i] == _estimate_single_mi(x, y, k)
+
+@pytest.mark.parametrize("a, b", [ (1, 2), (0.2, 0.3), (3, 3.1) ])
+def test_single_mi_sum_of_exponentials(a: float, b: float) -> None:
+    # We define X ~ Exp(1), W ~ Exp(2) and Y = X + W.
+    # Now by arXiv:1609.02911, Y has known, closed-form entropy.
+    rng = np.random.default_rng(20200302)
+    x = rng.exponential(1/a, 1000)
+    w = rng.exponential(1/b, 1000)
+    y = x + w
+
+    actual = _estimate_single_mi(x, y, k=5)
+    expected = np.euler_gamma + log((b-a)/a) + psi(b/(b-a))
+    assert actual == pytest.approx(expected, abs=0.025)
+
+@pytest.mark.parametrize("transformed, delta",
+    [ pytest.param(False, 0.04, id="identity"),
+      pytest.param(True, 0.02, id="transformed") ])
+def test_single_mi_independent_uniform(transformed: bool, delta: float) -> None:
+    # We have to use independent random numbers instead of linspace,
+    # because the algorithm has trouble with evenly spaced values.
+    # The transformed case reuses the same draws: scaling x and
+    # exponentiating y produces a very non-uniform density, but the MI
+    # should still be zero. (Scaling by 10 gives bit-for-bit the same
+    # values as sampling from U(0, 10) directly.)
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0.0, 1.0, 1024)
+    y = rng.uniform(0.0, 1.0, 1024)
+    if transformed:
+        x, y = 10 * x, np.exp(y)
+
+    actual = _estimate_single_mi(x, y, k=8)
+    assert actual == pytest.approx(0, abs=delta)
+
+def test_single_mi_independent_uniform_is_symmetric() -> None:
+    # Swapping the variables should not matter.
+    # A small sample suffices because the tolerance is so tight.
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0.0, 1.0, 256)
+    y = rng.uniform(0.0, 1.0, 256)
+
+    actual = _estimate_single_mi(x, y, k=8)
+    actual2 = _estimate_single_mi(y, x, k=8)
+    assert actual == pytest.approx(actual2, abs=0.00001)
+
+def test_single_mi_gamma_exponential() -> None:
+    # Kraskov et al. mention that this distribution is hard to estimate
+    # without logarithming the values.
+    # The analytical result is due to doi:10.1109/18.825848.
+    #
+    # x1      ~ Gamma(rate, shape)
+    # x2 | x1 ~ Exp(t * x1)
+    rng = np.random.default_rng(2)
+    r = 1.2
+    s = 3.4
+    t = 0.56
+
+    x1 = rng.gamma(shape=s, scale=1/r, size=1000)
+    x2 = rng.exponential(x1 * t)
+
+    raw = _estimate_single_mi(x1, x2)
+    trans = _estimate_single_mi(np.log(x1), np.log(x2))
+
+    expected = psi(s) - np.log(s) + 1/s
+    assert raw == pytest.approx(expected, abs=0.04)
+    assert trans == pytest.approx(expected, abs=0.005)
 
 
 class TestEstimateConditionalMi(unittest.TestCase):
@@ -201,21 +273,39 @@ class TestEstimateConditionalMi(unittest.TestCase):
                 rng = np.random.default_rng(0)
                 cov = np.array([[1, rho], [rho, 1]])
 
-                data = rng.multivariate_normal([0, 0], cov, size=n)
+                data = _sample_mvn(rng, cov, n)
                 x = data[:,0]
                 y = data[:,1]
                 cond = rng.uniform(0, 1, size=n)
 
                 actual = _estimate_conditional_mi(x, y, cond, k=k)
-                expected = -0.5 * log(1 - rho**2)
-                self.assertAlmostEqual(actual, expected, delta=delta)
+                self.assertAlmostEqual(actual, _gaussian_mi(rho), delta=delta)
+
+    def test_fast_gaussian_flag(self) -> None:
+        # With the opt-in flag, an independent condition is detected and the
+        # result matches the unconditional estimator exactly
+        rng = np.random.default_rng(0)
+        cov = np.array([[1, 0.75], [0.75, 1]])
+
+        data = _sample_mvn(rng, cov, 400)
+        x = data[:,0]
+        y = data[:,1]
+        cond = rng.uniform(0, 1, size=400)
+
+        fast = _estimate_conditional_mi(x, y, cond, k=3, fast_gaussian=True)
+        self.assertEqual(fast, _estimate_single_mi(x, y, k=3))
+
+        # A condition that does change the correlation is never short-circuited
+        self.assertAlmostEqual(
+            _estimate_conditional_mi(x, y, y, k=3, fast_gaussian=True),
+            0.0, delta=0.001)
 
     def test_gaussian_with_condition_equal_to_y(self) -> None:
         # MI(X;Y | Y) should be equal to 0
         rng = np.random.default_rng(4)
         cov = np.array([[1, 0.6], [0.6, 1]])
 
-        data = rng.multivariate_normal([0, 0], cov, size=314)
+        data = _sample_mvn(rng, cov, 314)
         x = data[:,0]
         y = data[:,1]
 
@@ -231,10 +321,13 @@ class TestEstimateConditionalMi(unittest.TestCase):
         rng = np.random.default_rng(5)
         cov = np.array([[1, 1, 1], [1, 4, 1], [1, 1, 9]])
 
-        data = rng.multivariate_normal([0, 0, 0], cov, size=1000)
+        data = _sample_mvn(rng, cov, 1000)
 
         actual = _estimate_conditional_mi(data[:,0], data[:,1], data[:,2])
-        expected = 0.5 * (log(8) + log(35) - log(9) - log(24))
+        expected = 0.5 * (np.linalg.slogdet(cov[np.ix_([0,2], [0,2])])[1]
+            + np.linalg.slogdet(cov[1:,1:])[1]
+            - log(cov[2,2])
+            - np.linalg.slogdet(cov)[1])
         self.assertAlmostEqual(actual, expected, delta=0.015)
 
     def test_four_gaussians(self) -> None:
@@ -254,7 +347,7 @@ class TestEstimateConditionalMi(unittest.TestCase):
 
         # The data needs to be normalized for estimation accuracy,
         # and the sample size must be quite large
-        data = rng.multivariate_normal([0, 0, 0, 0], cov, size=8000)
+        data = _sample_mvn(rng, cov, 8000)
         data = data / np.sqrt(np.var(data, axis=0))
 
         actual = _estimate_conditional_mi(data[:,0], data[:,1], data[:,2:])
@@ -400,6 +493,33 @@ class TestEstimateConditionalSemiDiscreteMi(unittest.TestCase):
 
 
 
+# Test the sorted-array interval counting used for marginal neighbor counts
+from ennemi._entropy_estimators import _count_within
+
+# One table-driven test covers all the cases in a single fixture cycle.
+# The bounds are exclusive, so elements exactly equal to a bound never count.
+_COUNT_WITHIN_CASES = [
+    pytest.param(np.arange(16.0), 3, 10, 6, id="power_of_two_array"),
+    pytest.param(np.asarray([0.0, 1.0, 4.0, 5.0, 9.0]), 0.5, 6.0, 3, id="odd_length_array"),
+    pytest.param(np.asarray([2.0]), 1.0, 3.0, 1, id="single_element_array"),
+    pytest.param(np.asarray([0.0, 1.0, 8.0, 9.0]), 2.0, 7.0, 0, id="none_matching"),
+    pytest.param(np.asarray([2.0, 2.0, 2.0, 3.0, 3.0, 3.0]), 2.0, 3.0, 0,
+        id="none_matching_in_duplicate_array_and_exact_bounds"),
+    pytest.param(np.arange(10.0), 4.0, 6.0, 1, id="exact_bounds_excluded"),
+    pytest.param(np.asarray([0.0, 1.0, 1.0, 1.0, 1.0, 2.0]), 0.0, 2.0, 4, id="repeated_values"),
+    pytest.param(np.arange(8.0), -1.0, 8.0, 8, id="all_elements_matching"),
+    pytest.param(np.arange(8.0), 10.0, 20.0, 0, id="bounds_outside_array"),
+    pytest.param(np.arange(16.0), np.asarray([3.0, -1.0, 14.5]),
+        np.asarray([10.0, 16.0, 14.5]), [6, 16, 0], id="vectorized_bounds"),
+]
+
+@pytest.mark.parametrize("array, lower, upper, expected", _COUNT_WITHIN_CASES)
+def test_count_within(array: np.ndarray,
+        lower: Union[float, np.ndarray], upper: Union[float, np.ndarray],
+        expected: Union[int, Sequence[int], np.ndarray]) -> None:
+    np.testing.assert_array_equal(_count_within(array, lower, upper), expected)
+
+
 # Test our custom implementation of the digamma function
 from ennemi._entropy_estimators import _psi
 